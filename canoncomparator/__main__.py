@@ -2,14 +2,14 @@ from __future__ import annotations
 
 import argparse
 import csv
-import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 from datetime import datetime
 
 from canoncomparator.config import load_config
 from canoncomparator.providers.lidarr import fetch_library_items
-from canoncomparator.mb_client import create_mb_session, fetch_rg_stats
-from canoncomparator.compare import build_rows
+from canoncomparator.mb_client import cancel_mb_requests, classify_cache, create_mb_session, fetch_rg_stats, open_cache, write_cache
+from canoncomparator.compare import CSV_FIELDS, build_rows
 from canoncomparator.overrides import load_overrides, write_overrides_sorted
 
 
@@ -30,10 +30,21 @@ def main() -> int:
     ap.add_argument("--lidarr-url", default=None, help="Lidarr base URL (overrides config)")
     ap.add_argument("--api-key", default=None, help="Lidarr API key (overrides config)")
     ap.add_argument("--limit-albums", type=int, default=None, help="Limit Lidarr albums for testing")
+    ap.add_argument(
+        "--verify-trackfiles",
+        action="store_true",
+        help="Recount each album via Lidarr /trackfile and report mismatches with its statistics (debugging; slower)",
+    )
 
     # MusicBrainz / cache
     ap.add_argument("--limit-rgids", type=int, default=None, help="Limit RGIDs sent to MusicBrainz (fast testing)")
     ap.add_argument("--max-age-days", type=float, default=None, help="MB cache max age in days (-1 = never refetch, 0 = always refetch)")
+    ap.add_argument("--mb-workers", type=int, default=8, help="Worker threads for MB lookups (requests stay throttled to 1/s)")
+    ap.add_argument(
+        "--checkpoint",
+        action="store_true",
+        help="Write each MB result to the cache as soon as it is fetched (safer for long runs; slower)",
+    )
 
     # Output
     ap.add_argument(
@@ -71,18 +82,12 @@ def main() -> int:
         api_key=api_key,
         limit_albums=args.limit_albums,
         include_unmapped=False,
+        verify_trackfiles=args.verify_trackfiles,
     )
 
     if args.limit_rgids is not None:
         items = items[: args.limit_rgids]
 
-    # RGID to label map
-    rgid_to_label = {}
-    for it in items:
-        label = f"{it.artist or ''} - {it.title or ''}".strip(" -")
-        if it.rgid not in rgid_to_label:
-            rgid_to_label[it.rgid] = label
-
     # Fetch MB stats (cached)
     if max_age_days < 0:
         policy = "never refetch"
@@ -93,30 +98,62 @@ def main() -> int:
 
     print(f"MB cache policy: {policy}")
 
-    mb_session = create_mb_session(cfg)
+    cache_conn = open_cache(cache_path)
+    hits, misses = classify_cache(cache_conn, (it.rgid for it in items), max_age_days)
+    print(f"MB cache: {len(hits)} cached, {len(misses)} to fetch")
+
+    mb_stats = dict(hits)
+    mb_status = {rgid: "cached" for rgid in hits}
+    pending_writes = []
+    total = len(misses)
 
-    mb_stats = {}
-    mb_status = {}
-    total = len(items)
+    mb_session = create_mb_session(cfg)
 
-    for i, it in enumerate(items, start=1):
+    def _fetch(rgid: str):
         try:
-            stats, status = fetch_rg_stats(
-                session=mb_session,
-                cache_path=cache_path,
-                rgid=it.rgid,
-                max_age_days=max_age_days,
-            )
+            return fetch_rg_stats(session=mb_session, rgid=rgid, fetch_reason=misses[rgid])
         except Exception as e:
-            stats, status = None, f"failed ({type(e).__name__})"
-
-        print(f"[{i}/{total}] MB {status}: {it.rgid}")
-        mb_stats[it.rgid] = stats
-        mb_status[it.rgid] = status
+            return None, f"failed ({type(e).__name__})"
+
+    try:
+        # Skip the pool entirely when everything is cached. Requests are still gated
+        # to 1/s inside mb_client; the pool only overlaps latency and JSON decoding.
+        if misses:
+            pool = ThreadPoolExecutor(max_workers=max(1, args.mb_workers))
+            futures = {pool.submit(_fetch, rgid): rgid for rgid in misses}
+            try:
+                for i, fut in enumerate(as_completed(futures), start=1):
+                    rgid = futures[fut]
+                    stats, status = fut.result()
+                    print(f"[{i}/{total}] MB {status}: {rgid}")
+                    mb_stats[rgid] = stats
+                    mb_status[rgid] = status
+
+                    if stats is not None:
+                        if args.checkpoint:
+                            write_cache(cache_conn, [stats])
+                        else:
+                            pending_writes.append(stats)
+            except BaseException:
+                # Ctrl+C / error: drop the queued lookups and wake the workers waiting on
+                # the throttle, instead of letting everything still run at 1 req/s
+                cancel_mb_requests()
+                pool.shutdown(wait=False, cancel_futures=True)
+                # Keep lookups that completed after the loop stopped consuming results
+                for fut, rgid in futures.items():
+                    if rgid not in mb_status and fut.done() and not fut.cancelled() and fut.exception() is None:
+                        stats, _status = fut.result()
+                        if stats is not None:
+                            pending_writes.append(stats)
+                raise
+            pool.shutdown()
+    finally:
+        # One batched cache write for everything fetched (also on Ctrl+C / errors)
+        write_cache(cache_conn, pending_writes)
+        cache_conn.close()
+        mb_session.close()
 
     # Merge + write CSV (Excel-friendly UTF-8 with BOM)
-    rows = build_rows(items, mb_stats, mb_status, overrides)
-
     if args.out:
         out_path = Path(args.out)
     else:
@@ -124,40 +161,20 @@ def main() -> int:
         out_path = Path(f"cancomp_{ts}.csv")
     out_path.parent.mkdir(parents=True, exist_ok=True)
 
-    fieldnames = [
-        "rgid",
-        "mb_release_group_url",
-        "artist",
-        "title",
-        "owned_track_count",
-        "canon_track_counts",
-        "min_owned_minus_canon",
-        "owned_matches_canon",
-        "canon_source",
-        "mb_mode_track_count",
-        "diff_owned_minus_mode",
-        "mode_release_count",
-        "owned_trackcount_release_count",
-        "mb_release_count",
-        "mb_histogram_tracks_releases_json",
-        "mb_fetch_status",
-        "override_suggestion",
-    ]
-
+    row_count = 0
     with out_path.open("w", newline="", encoding="utf-8-sig") as f:
-        w = csv.DictWriter(f, fieldnames=fieldnames)
-        w.writeheader()
-        for r in rows:
-            # ensure histogram is a JSON string for CSV friendliness
-            r = dict(r)
-            hist = r.get("mb_histogram_tracks_releases_json", {})
-            r["mb_histogram_tracks_releases_json"] = json.dumps(hist, ensure_ascii=False, sort_keys=True)
+        w = csv.writer(f)
+        w.writerow(CSV_FIELDS)
+        for r in build_rows(items, mb_stats, mb_status, overrides):
             w.writerow(r)
-            
-    print(f"Wrote {len(rows)} rows to {out_path}")
+            row_count += 1
+
+    print(f"Wrote {row_count} rows to {out_path}")
     
     # Sort the overrides list
     if args.sort_overrides:
+        # Labels are prebuilt on each item (one item per RGID), so this is just a lookup table
+        rgid_to_label = {it.rgid: it.label or "" for it in items}
         write_overrides_sorted(overrides_path, overrides, rgid_to_label)
         print(f"Sorted overrides written to {overrides_path}")
         
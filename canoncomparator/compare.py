@@ -1,11 +1,34 @@
 from __future__ import annotations
 
-from typing import Dict, List
+import json
+from typing import Dict, Iterator, List, Tuple
 
 from canoncomparator.types import LibraryItem
 from canoncomparator.mb_client import MbRgStats
 
 
+# CSV column order; build_rows yields its values in exactly this order
+CSV_FIELDS: Tuple[str, ...] = (
+    "rgid",
+    "mb_release_group_url",
+    "artist",
+    "title",
+    "owned_track_count",
+    "canon_track_counts",
+    "min_owned_minus_canon",
+    "owned_matches_canon",
+    "canon_source",
+    "mb_mode_track_count",
+    "diff_owned_minus_mode",
+    "mode_release_count",
+    "owned_trackcount_release_count",
+    "mb_release_count",
+    "mb_histogram_tracks_releases_json",
+    "mb_fetch_status",
+    "override_suggestion",
+)
+
+
 def build_override_suggestion(rgid: str, owned: int, mb_mode: int | None, label: str) -> str:
     vals = [owned]
     if mb_mode is not None:
@@ -24,8 +47,11 @@ def build_rows(
     mb_stats: Dict[str, MbRgStats | None],
     mb_status: Dict[str, str],
     overrides: Dict[str, List[int]],
-) -> List[dict]:
-    rows: List[dict] = []
+) -> Iterator[tuple]:
+    """
+    Yields one CSV-ready row per item as a tuple in CSV_FIELDS order (histogram
+    already JSON-encoded), so the caller can stream rows straight to csv.writer.
+    """
     for it in items:
         st = mb_stats.get(it.rgid)
         status = mb_status.get(it.rgid, "")
@@ -38,8 +64,6 @@ def build_rows(
         mode_release_count = hist.get(mode_tc, 0) if (mode_tc is not None) else 0
         owned_release_count = hist.get(it.owned_track_count, 0)
 
-        label = f"{it.artist or ''} - {it.title or ''}".strip(" -")
-
         # canon logic
         if it.rgid in overrides and overrides[it.rgid]:
             canon_counts = overrides[it.rgid]
@@ -61,7 +85,7 @@ def build_rows(
                 rgid=it.rgid,
                 owned=it.owned_track_count,
                 mb_mode=mode_tc,
-                label=label,
+                label=it.label,
             )
 
         diff = (it.owned_track_count - mode_tc) if (mode_tc is not None) else ""
@@ -79,28 +103,22 @@ def build_rows(
                 # If tie, choose the most negative (so below-canon shows negative)
                 min_owned_minus_canon = min(closest)
 
-        rows.append({
-            "rgid": it.rgid,
-            "mb_release_group_url": f"https://musicbrainz.org/release-group/{it.rgid}",
-            "artist": it.artist or "",
-            "title": it.title or "",
-            "min_owned_minus_canon": min_owned_minus_canon,
-            "owned_track_count": it.owned_track_count,
-
-            "mb_mode_track_count": mode_tc if mode_tc is not None else "",
-            "mode_release_count": mode_release_count if mode_tc is not None else "",
-            "owned_trackcount_release_count": owned_release_count if st else "",
-
-            "canon_track_counts": ", ".join(str(x) for x in canon_counts),
-            "canon_source": canon_source,
-            "owned_matches_canon": str(owned_matches_canon),
-
-            "diff_owned_minus_mode": diff,
-            "mb_release_count": st.release_count if st else "",
-
-            "mb_histogram_tracks_releases_json": hist,
-            "mb_fetch_status": status,
-            "override_suggestion": override_suggestion,
-        })
-
-    return rows
+        yield (
+            it.rgid,                                                    # rgid
+            f"https://musicbrainz.org/release-group/{it.rgid}",         # mb_release_group_url
+            it.artist or "",                                            # artist
+            it.title or "",                                             # title
+            it.owned_track_count,                                       # owned_track_count
+            ", ".join(str(x) for x in canon_counts),                    # canon_track_counts
+            min_owned_minus_canon,                                      # min_owned_minus_canon
+            str(owned_matches_canon),                                   # owned_matches_canon
+            canon_source,                                               # canon_source
+            mode_tc if mode_tc is not None else "",                     # mb_mode_track_count
+            diff,                                                       # diff_owned_minus_mode
+            mode_release_count if mode_tc is not None else "",          # mode_release_count
+            owned_release_count if st else "",                          # owned_trackcount_release_count
+            st.release_count if st else "",                             # mb_release_count
+            json.dumps(hist, ensure_ascii=False, sort_keys=True),       # mb_histogram_tracks_releases_json
+            status,                                                     # mb_fetch_status
+            override_suggestion,                                        # override_suggestion
+        )
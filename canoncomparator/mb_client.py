@@ -2,17 +2,31 @@ from __future__ import annotations
 
 import json
 import sqlite3
+from collections import Counter
+import threading
 import time
 import random
-import requests
+import httpx
+import orjson
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Dict, Optional, Tuple
+from typing import Dict, Iterable, List, Optional, Tuple
 
 
 MB_BASE = "https://musicbrainz.org/ws/2"
 _MB_MIN_INTERVAL = 1.0
+_MB_CONNECT_RETRIES = 3
 _last_mb_request = 0.0
+_mb_backoff_until = 0.0            # set from 429/5xx backoff; holds back every thread
+_mb_throttle_lock = threading.Lock()
+_mb_cancelled = threading.Event()  # set by cancel_mb_requests(); wakes waiting workers
+
+_CACHE_SCHEMA_VERSION = 2          # PRAGMA user_version; 2 = rg_hist rows stamped with fetched_at
+_CACHE_QUERY_CHUNK = 900           # stay under SQLITE_MAX_VARIABLE_NUMBER
+
+
+class MbCancelled(RuntimeError):
+    pass
 
 
 @dataclass(frozen=True)
@@ -32,40 +46,92 @@ def build_user_agent(cfg: dict) -> str:
     return f"{app}/{version} ( {contact} )"
 
 
-def create_mb_session(cfg: dict) -> requests.Session:
-    s = requests.Session()
-    s.headers.update({
-        "User-Agent": build_user_agent(cfg),
-        "Accept": "application/json",
-    })
-    return s
+def create_mb_session(cfg: dict) -> httpx.Client:
+    """
+    HTTP/2 keep-alive client; the lookup threads share it so they multiplex over
+    one TLS connection instead of handshaking per request.
+    """
+    # Failed connection attempts (ConnectError / ConnectTimeout) are retried only here,
+    # inside the transport; _mb_get re-raises them once these retries are used up.
+    # 429/5xx + Retry-After stay in _mb_get (httpx has no status-based retry).
+    transport = httpx.HTTPTransport(
+        http2=True,
+        retries=_MB_CONNECT_RETRIES,
+        limits=httpx.Limits(max_connections=4, max_keepalive_connections=4),
+    )
+    return httpx.Client(
+        transport=transport,
+        timeout=60,
+        headers={
+            "User-Agent": build_user_agent(cfg),
+            "Accept": "application/json",
+        },
+    )
+
+
+def _wait_for_mb_slot() -> None:
+    """
+    Block until this thread may issue the next MB request.
+
+    Only the slot reservation is serialized (under _mb_throttle_lock); the lock is
+    released before the caller performs the HTTP request, so several threads can
+    have requests in flight while still starting at most one per _MB_MIN_INTERVAL.
+    If another thread hit a backoff while we slept, take a new slot after it.
+    """
+    global _last_mb_request
+
+    while True:
+        with _mb_throttle_lock:
+            now = time.time()
+            slot = max(now, _last_mb_request + _MB_MIN_INTERVAL)
+            _last_mb_request = slot
+
+        # Event.wait instead of sleep so cancel_mb_requests() stops us immediately
+        if _mb_cancelled.wait(max(0.0, slot - now)):
+            raise MbCancelled("MB requests cancelled")
+
+        if time.time() >= _mb_backoff_until:
+            return
+
+
+def cancel_mb_requests() -> None:
+    """
+    Stop all MB traffic for the rest of the run (e.g., on Ctrl+C): workers waiting
+    for a throttle slot raise MbCancelled instead of sending their request.
+    """
+    _mb_cancelled.set()
+
+
+def _defer_mb_requests(delay_s: float) -> None:
+    """
+    Pause all MB traffic (every worker thread) for delay_s, e.g. on Retry-After.
+    """
+    global _last_mb_request, _mb_backoff_until
+
+    with _mb_throttle_lock:
+        until = time.time() + delay_s
+        _mb_backoff_until = max(_mb_backoff_until, until)
+        _last_mb_request = max(_last_mb_request, until)
 
 
-def _mb_get(session: requests.Session, path: str, params: dict) -> dict:
+def _mb_get(session: httpx.Client, path: str, params: dict) -> dict:
     """
     MusicBrainz GET with:
-      - global 1 req/sec throttling (via _MB_MIN_INTERVAL / _last_mb_request)
-      - retries on transient network errors and 429/5xx responses
+      - global 1 req/sec throttling across threads (via _wait_for_mb_slot)
+      - retries on 429/5xx responses and on network errors after the connection was
+        made (connect failures are retried by the transport only)
       - exponential backoff with small jitter
     """
-    global _last_mb_request
-
     max_retries = 5
     last_exc: Exception | None = None
 
     for attempt in range(max_retries + 1):
         try:
-            # --- polite throttling (keep your original behavior) ---
-            now = time.time()
-            dt = now - _last_mb_request
-            if dt < _MB_MIN_INTERVAL:
-                time.sleep(_MB_MIN_INTERVAL - dt)
+            # --- polite throttling (shared by all worker threads) ---
+            _wait_for_mb_slot()
 
             url = f"{MB_BASE}{path}"
-            r = session.get(url, params=params, timeout=60)
-
-            # Update last request time after we actually attempted a request
-            _last_mb_request = time.time()
+            r = session.get(url, params=params)
 
             # Retry on "too many requests" or transient server errors
             if r.status_code in (429, 500, 502, 503, 504):
@@ -81,19 +147,22 @@ def _mb_get(session: requests.Session, path: str, params: dict) -> dict:
                     sleep_s = min(30.0, (2 ** attempt)) + random.uniform(0.0, 0.5)
 
                 if attempt < max_retries:
-                    print(f"MB retry {attempt+1}/{max_retries} (HTTP {r.status_code}); sleeping {sleep_s:.1f}s")
-                    time.sleep(sleep_s)
+                    print(f"MB retry {attempt+1}/{max_retries} (HTTP {r.status_code}); pausing MB requests {sleep_s:.1f}s")
+                    # Back off globally, not just this worker; _wait_for_mb_slot does the waiting
+                    _defer_mb_requests(sleep_s)
                     continue
 
             r.raise_for_status()
-            return r.json()
-
-        except (
-            requests.exceptions.Timeout,
-            requests.exceptions.ConnectionError,
-            requests.exceptions.SSLError,
-            requests.exceptions.ChunkedEncodingError,
-        ) as e:
+            # orjson parses straight from bytes and is much faster than r.json()
+            return orjson.loads(r.content)
+
+        except (httpx.ConnectError, httpx.ConnectTimeout):
+            # Already retried _MB_CONNECT_RETRIES times by the transport; don't multiply that
+            raise
+
+        except httpx.TransportError as e:
+            # Covers read/write timeouts and protocol errors (e.g. a stream reset) on an
+            # established connection
             last_exc = e
             if attempt < max_retries:
                 sleep_s = min(30.0, (2 ** attempt)) + random.uniform(0.0, 0.5)
@@ -110,35 +179,33 @@ def _mb_get(session: requests.Session, path: str, params: dict) -> dict:
 
 def _release_total_tracks(release_obj: dict) -> Optional[int]:
     """
-    Total tracks across all media. Uses media[].track-count when present.
+    Total tracks across all media. Uses media[].track-count when present,
+    otherwise the length of media[].tracks. None if the release has no media.
     """
     media = release_obj.get("media")
-    if not isinstance(media, list) or not media:
+    if not media or not isinstance(media, list):
         return None
 
     total = 0
     for m in media:
         tc = m.get("track-count")
-        if isinstance(tc, int):
-            total += tc
-        else:
-            # fallback if track-count missing but tracks present
-            tracks = m.get("tracks")
-            if isinstance(tracks, list):
-                total += len(tracks)
-            else:
-                return None
+        total += tc if tc is not None else len(m.get("tracks") or ())
     return total
 
 
 def _mode_from_hist(hist: Dict[int, int]) -> Optional[int]:
     if not hist:
         return None
-    # Highest frequency; tie-breaker: smallest track count
-    return sorted(hist.items(), key=lambda kv: (-kv[1], kv[0]))[0][0]
+    # Highest frequency; tie-breaker: smallest track count (single pass, no sort)
+    best = max(hist.items(), key=lambda kv: (kv[1], -kv[0]))
+    return best[0]
 
 
 def _ensure_cache(conn: sqlite3.Connection) -> None:
+    """
+    Called once per run from open_cache(). The DDL runs outside a transaction
+    (sqlite3 autocommits it), so only the one-time backfill needs a commit.
+    """
     conn.execute("""
         CREATE TABLE IF NOT EXISTS rg_cache (
             rgid TEXT PRIMARY KEY,
@@ -148,30 +215,139 @@ def _ensure_cache(conn: sqlite3.Connection) -> None:
             histogram_json TEXT NOT NULL
         )
     """)
-    conn.commit()
+    # Histogram rows, so cache hits are read without any JSON parsing. Each row
+    # carries the fetched_at of the rg_cache row it belongs to: older versions only
+    # update rg_cache (incl. histogram_json), and a mismatch means rg_hist is outdated.
+    (version,) = conn.execute("PRAGMA user_version").fetchone()
+    migrate = version < _CACHE_SCHEMA_VERSION
+    if migrate:
+        # rg_hist is derived data; rebuild it (schema 1 had no fetched_at column)
+        conn.execute("DROP TABLE IF EXISTS rg_hist")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS rg_hist (
+            rgid TEXT NOT NULL,
+            track_count INTEGER NOT NULL,
+            freq INTEGER NOT NULL,
+            fetched_at REAL NOT NULL,
+            PRIMARY KEY (rgid, track_count)
+        ) WITHOUT ROWID
+    """)
 
+    if migrate:
+        # One-time backfill of rg_hist from histogram_json
+        conn.execute("""
+            INSERT OR REPLACE INTO rg_hist (rgid, track_count, freq, fetched_at)
+            SELECT c.rgid, CAST(h.key AS INTEGER), h.value, c.fetched_at
+            FROM rg_cache AS c, json_each(c.histogram_json) AS h
+        """)
+        conn.execute(f"PRAGMA user_version={_CACHE_SCHEMA_VERSION}")
+        conn.commit()
 
-def _read_cache(conn: sqlite3.Connection, rgid: str, max_age_days: float) -> Optional[MbRgStats]:
-    row = conn.execute(
-        "SELECT rgid, fetched_at, release_count, mode_track_count, histogram_json FROM rg_cache WHERE rgid=?",
-        (rgid,)
-    ).fetchone()
-    if not row:
-        return None
-    rgid, fetched_at, release_count, mode_track_count, histogram_json = row
+
+def _is_fresh(fetched_at: float, max_age_days: float) -> bool:
     if max_age_days < 0:
-        pass
-    elif max_age_days == 0:
-        return None
-    elif (time.time() - fetched_at) > max_age_days * 86400:
-        return None
-    hist = {int(k): int(v) for k, v in json.loads(histogram_json).items()}
-    return MbRgStats(rgid=rgid, fetched_at=fetched_at, release_count=release_count,
-                     mode_track_count=mode_track_count, histogram=hist)
+        return True
+    if max_age_days == 0:
+        return False
+    return (time.time() - fetched_at) <= max_age_days * 86400
 
 
-def _write_cache(conn: sqlite3.Connection, stats: MbRgStats) -> None:
-    conn.execute("""
+def open_cache(cache_path: str | Path) -> sqlite3.Connection:
+    """
+    Open the MB cache once per run. Only the caller's thread uses it: lookups
+    return their stats and the caller persists them with write_cache().
+    """
+    cache_path = Path(cache_path).expanduser()
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+
+    conn = sqlite3.connect(str(cache_path), timeout=30)
+    _ensure_cache(conn)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+def classify_cache(
+    conn: sqlite3.Connection,
+    rgids: Iterable[str],
+    max_age_days: float,
+) -> Tuple[Dict[str, MbRgStats], Dict[str, str]]:
+    """
+    Plan the MB stage up front: split rgids into cache hits and the ones to fetch.
+
+    Returns (hits, misses): hits maps RGID -> fresh cached stats; misses maps
+    RGID -> fetch reason ("fetched (not in cache)", "fetched (cache expired)" or
+    "fetched (forced)"), in input order. Freshness is checked first, so
+    histograms are only loaded for hits.
+    """
+    wanted = list(dict.fromkeys(rgids))
+    hits: Dict[str, MbRgStats] = {}
+    stale: set[str] = set()
+    for start in range(0, len(wanted), _CACHE_QUERY_CHUNK):
+        chunk = wanted[start:start + _CACHE_QUERY_CHUNK]
+        marks = ", ".join("?" * len(chunk))
+        rows = conn.execute(
+            "SELECT rgid, fetched_at, release_count, mode_track_count "
+            f"FROM rg_cache WHERE rgid IN ({marks})",
+            chunk,
+        ).fetchall()
+
+        fresh: Dict[str, Tuple[float, int, Optional[int]]] = {}
+        for rgid, fetched_at, release_count, mode_track_count in rows:
+            if _is_fresh(float(fetched_at), max_age_days):
+                fresh[rgid] = (float(fetched_at), int(release_count), mode_track_count)
+            else:
+                stale.add(rgid)
+        if not fresh:
+            continue
+
+        # Only rg_hist rows written together with the current rg_cache row count
+        hists: Dict[str, Dict[int, int]] = {}
+        marks = ", ".join("?" * len(fresh))
+        for rgid, track_count, freq in conn.execute(
+            "SELECT h.rgid, h.track_count, h.freq FROM rg_hist AS h "
+            "JOIN rg_cache AS c ON c.rgid = h.rgid AND c.fetched_at = h.fetched_at "
+            f"WHERE h.rgid IN ({marks})",
+            list(fresh),
+        ):
+            hists.setdefault(rgid, {})[track_count] = freq
+
+        # No matching rows: written by an older version (or an empty histogram),
+        # so fall back to histogram_json for just these RGIDs
+        fallback = [rgid for rgid in fresh if rgid not in hists]
+        if fallback:
+            marks = ", ".join("?" * len(fallback))
+            for rgid, histogram_json in conn.execute(
+                f"SELECT rgid, histogram_json FROM rg_cache WHERE rgid IN ({marks})",
+                fallback,
+            ):
+                hists[rgid] = {int(k): int(v) for k, v in json.loads(histogram_json).items()}
+
+        for rgid, (fetched_at, release_count, mode_track_count) in fresh.items():
+            hits[rgid] = MbRgStats(
+                rgid=rgid,
+                fetched_at=fetched_at,
+                release_count=release_count,
+                mode_track_count=mode_track_count,
+                histogram=hists[rgid],
+            )
+
+    stale_reason = "fetched (forced)" if max_age_days == 0 else "fetched (cache expired)"
+    misses: Dict[str, str] = {}
+    for rgid in wanted:
+        if rgid in hits:
+            continue
+        misses[rgid] = stale_reason if rgid in stale else "fetched (not in cache)"
+    return hits, misses
+
+
+def write_cache(conn: sqlite3.Connection, stats: List[MbRgStats]) -> None:
+    """
+    Upsert freshly fetched stats in one transaction (one commit for the batch).
+    """
+    if not stats:
+        return
+    conn.executemany("""
         INSERT INTO rg_cache (rgid, fetched_at, release_count, mode_track_count, histogram_json)
         VALUES (?, ?, ?, ?, ?)
         ON CONFLICT(rgid) DO UPDATE SET
@@ -179,105 +355,77 @@ def _write_cache(conn: sqlite3.Connection, stats: MbRgStats) -> None:
             release_count=excluded.release_count,
             mode_track_count=excluded.mode_track_count,
             histogram_json=excluded.histogram_json
-    """, (
-        stats.rgid,
-        stats.fetched_at,
-        stats.release_count,
-        stats.mode_track_count,
-        json.dumps({str(k): v for k, v in stats.histogram.items()}, ensure_ascii=False),
-    ))
+    """, [
+        (
+            st.rgid,
+            st.fetched_at,
+            st.release_count,
+            st.mode_track_count,
+            json.dumps({str(k): v for k, v in st.histogram.items()}, ensure_ascii=False),
+        )
+        for st in stats
+    ])
+    conn.executemany("DELETE FROM rg_hist WHERE rgid=?", [(st.rgid,) for st in stats])
+    conn.executemany(
+        "INSERT INTO rg_hist (rgid, track_count, freq, fetched_at) VALUES (?, ?, ?, ?)",
+        [(st.rgid, tc, freq, st.fetched_at) for st in stats for tc, freq in st.histogram.items()],
+    )
     conn.commit()
 
 
 def fetch_rg_stats(
-    session: requests.Session,
-    cache_path: str | Path,
+    session: httpx.Client,
     rgid: str,
-    max_age_days: float = 30.0,
+    fetch_reason: str = "fetched (not in cache)",
 ) -> Tuple[Optional[MbRgStats], str]:
-    cache_path = Path(cache_path).expanduser()
-    cache_path.parent.mkdir(parents=True, exist_ok=True)
-
-    conn = sqlite3.connect(str(cache_path))
+    """
+    Fetch one release-group from MB; meant for the misses from classify_cache().
+    Returns (stats, fetch_reason), or (None, "failed (...)"). Nothing is written
+    here; the caller persists fetched stats with write_cache().
+    """
+    # --- MB fetch (may fail); do NOT crash the whole run ---
     try:
-        _ensure_cache(conn)
-
-        row = conn.execute(
-            "SELECT rgid, fetched_at, release_count, mode_track_count, histogram_json "
-            "FROM rg_cache WHERE rgid=?",
-            (rgid,),
-        ).fetchone()
-
-        if row:
-            _rgid, fetched_at, release_count, mode_track_count, histogram_json = row
-            hist = {int(k): int(v) for k, v in json.loads(histogram_json).items()}
-            cached_stats = MbRgStats(
-                rgid=rgid,
-                fetched_at=float(fetched_at),
-                release_count=int(release_count),
-                mode_track_count=mode_track_count,
-                histogram=hist,
-            )
-
-            if max_age_days < 0:
-                return cached_stats, "cached"
-            if max_age_days == 0:
-                fetch_reason = "fetched (forced)"
-            elif (time.time() - float(fetched_at)) <= max_age_days * 86400:
-                return cached_stats, "cached"
-            else:
-                fetch_reason = "fetched (cache expired)"
-        else:
-            fetch_reason = "fetched (not in cache)"
-
-        # --- MB fetch (may fail); do NOT crash the whole run ---
-        try:
-            limit = 100
-            offset = 0
-            hist: Dict[int, int] = {}
-            release_count = 0
-
-            while True:
-                data = _mb_get(session, "/release", params={
-                    "release-group": rgid,
-                    "inc": "media",
-                    "fmt": "json",
-                    "limit": str(limit),
-                    "offset": str(offset),
-                })
-
-                releases = data.get("releases", [])
-                if not isinstance(releases, list):
-                    releases = []
-
-                for rel in releases:
-                    release_count += 1
-                    tc = _release_total_tracks(rel)
-                    if tc is None:
-                        continue
-                    hist[tc] = hist.get(tc, 0) + 1
-
-                total = data.get("release-count")
-                if not isinstance(total, int):
-                    break
-                offset += limit
-                if offset >= total:
-                    break
-
-            mode_tc = _mode_from_hist(hist)
-            stats = MbRgStats(
-                rgid=rgid,
-                release_count=release_count,
-                mode_track_count=mode_tc,
-                histogram=hist,
-                fetched_at=time.time(),
-            )
-            _write_cache(conn, stats)
-            return stats, fetch_reason
-
-        except Exception as e:
-            # Keep going; CSV row will just have blank MB fields
-            return None, f"failed ({type(e).__name__})"
+        limit = 100
+        offset = 0
+        hist: Counter[int] = Counter()
+        release_count = 0
+
+        while True:
+            # inc=media is the smallest include that carries media[].track-count
+            data = _mb_get(session, "/release", params={
+                "release-group": rgid,
+                "inc": "media",
+                "fmt": "json",
+                "limit": str(limit),
+                "offset": str(offset),
+            })
+
+            releases = data.get("releases", [])
+            if not isinstance(releases, list):
+                releases = []
+
+            release_count += len(releases)
+            # Counter.update counts an iterable in C (no per-element dict get/set)
+            totals = [t for t in map(_release_total_tracks, releases) if t is not None]
+            hist.update(totals)
+
+            # Most RGs fit on the first page: stop as soon as every release has been
+            # seen, or when MB hands back a short page, instead of asking for more
+            total = data.get("release-count")
+            if not isinstance(total, int) or release_count >= total or len(releases) < limit:
+                break
+            offset += limit
+
+        mode_tc = _mode_from_hist(hist)
+        stats = MbRgStats(
+            rgid=rgid,
+            release_count=release_count,
+            mode_track_count=mode_tc,
+            histogram=hist,
+            fetched_at=time.time(),
+        )
+        return stats, fetch_reason
 
-    finally:
-        conn.close()
+    except Exception as e:
+        # Keep going; CSV row will just have blank MB fields
+        return None, f"failed ({type(e).__name__})"
@@ -1,13 +1,19 @@
 from __future__ import annotations
 
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from typing import Dict, Iterable, List, Optional, Tuple
 
 import requests
+from requests.adapters import HTTPAdapter
 
 from canoncomparator.types import LibraryItem
 
 
+# Lidarr is a local service with no rate limit, so --verify-trackfiles lookups run in parallel
+_TRACKFILE_WORKERS = 16
+
+
 class LidarrError(RuntimeError):
     pass
 
@@ -25,11 +31,37 @@ def _lidarr_get(session: requests.Session, base_url: str, path: str, params: Opt
     return r.json()
 
 
+def _verify_trackfile_counts(
+    session: requests.Session,
+    base_url: str,
+    album_counts: List[Tuple[int, int]],
+) -> List[Tuple[int, int]]:
+    """
+    Debug path: recount each album from /trackfile?albumId= and report any album whose
+    statistics.trackFileCount disagrees. Returns (albumId, count) using the trackfile counts.
+    """
+    def _fetch_trackfiles(album_id: int):
+        return album_id, _lidarr_get(session, base_url, "/api/v1/trackfile", params={"albumId": album_id})
+
+    with ThreadPoolExecutor(max_workers=_TRACKFILE_WORKERS) as pool:
+        results = list(pool.map(_fetch_trackfiles, [album_id for album_id, _count in album_counts]))
+
+    verified: List[Tuple[int, int]] = []
+    for (album_id, stat_count), (_album_id, tfs) in zip(album_counts, results):
+        if not isinstance(tfs, list):
+            raise LidarrError(f"Unexpected /trackfile response type for albumId={album_id}: {type(tfs)}")
+        if len(tfs) != stat_count:
+            print(f"Lidarr albumId={album_id}: statistics.trackFileCount={stat_count}, /trackfile returned {len(tfs)}")
+        verified.append((album_id, len(tfs)))
+    return verified
+
+
 def fetch_library_items(
     lidarr_url: str,
     api_key: str,
     limit_albums: Optional[int] = None,
     include_unmapped: bool = False,
+    verify_trackfiles: bool = False,
 ) -> List[LibraryItem]:
     """
     Returns LibraryItem list aggregated by MusicBrainz Release Group MBID (RGID).
@@ -37,13 +69,18 @@ def fetch_library_items(
     owned_track_count = number of Lidarr trackfiles mapped to that RGID.
 
     Note:
-    - Your Lidarr requires trackfile filters, so we fetch trackfiles per albumId.
+    - Counts come from AlbumResource.statistics.trackFileCount, so the only request is /album.
+      verify_trackfiles=True recounts every album via /trackfile?albumId= (debugging).
     - RGID source is AlbumResource.foreignAlbumId (what you validated in PS).
     - Unmapped trackfiles can't be assigned an RGID, so they are ignored unless you later
       want a separate report (include_unmapped here is kept for future expansion).
     """
     session = requests.Session()
     session.headers.update({"X-Api-Key": api_key})
+    # Pool sized above the worker count so threads never wait on a connection
+    adapter = HTTPAdapter(pool_connections=32, pool_maxsize=32)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
 
     # 1) Fetch all albums once
     albums = _lidarr_get(session, lidarr_url, "/api/v1/album")
@@ -68,24 +105,25 @@ def fetch_library_items(
     if limit_albums is not None:
         albums_with_files = albums_with_files[:limit_albums]
 
-    # 2) For each album with files, fetch trackfiles (filtered by albumId)
-    # Then count trackfiles by RGID
+    # 2) Count trackfiles by RGID (statistics.trackFileCount is already on each album)
     rgid_to_count: Dict[str, int] = {}
     rgid_to_display: Dict[str, Tuple[Optional[str], Optional[str]]] = {}  # (artist, title)
 
-    for a in albums_with_files:
-        album_id = a["id"]
-        tfs = _lidarr_get(session, lidarr_url, "/api/v1/trackfile", params={"albumId": album_id})
-        if not isinstance(tfs, list):
-            raise LidarrError(f"Unexpected /trackfile response type for albumId={album_id}: {type(tfs)}")
+    # Albums without an RGID can't be used for CanComp
+    album_counts: List[Tuple[int, int]] = [
+        (a["id"], int(a["statistics"]["trackFileCount"]))
+        for a in albums_with_files
+        if album_map[a["id"]][0]
+    ]
+
+    if verify_trackfiles:
+        album_counts = _verify_trackfile_counts(session, lidarr_url, album_counts)
 
-        rgid, artist, title = album_map.get(album_id, (None, None, None))
-        if not rgid:
-            # If Lidarr album doesn't have RGID, we can't use it for CanComp
-            continue
+    for album_id, count in album_counts:
+        rgid, artist, title = album_map[album_id]
 
         # Count trackfiles for this RGID
-        rgid_to_count[rgid] = rgid_to_count.get(rgid, 0) + len(tfs)
+        rgid_to_count[rgid] = rgid_to_count.get(rgid, 0) + count
 
         # Save something nice to display (first seen wins)
         if rgid not in rgid_to_display:
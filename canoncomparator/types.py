@@ -8,3 +8,9 @@ class LibraryItem:
     artist: Optional[str] = None
     title: Optional[str] = None
     source_id: Optional[str] = None  # e.g., Lidarr albumId (debugging)
+    label: Optional[str] = None      # "Artist - Title"; derived from artist/title if not given
+
+    def __post_init__(self) -> None:
+        # Build the label once per item (frozen, so set it via object.__setattr__)
+        if self.label is None:
+            object.__setattr__(self, "label", f"{self.artist or ''} - {self.title or ''}".strip(" -"))